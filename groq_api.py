@@ -1,23 +1,21 @@
 import os
 import base64
-from groq import Groq
+from groq import AsyncGroq
 from dotenv import load_dotenv
 
-image_path = "image.jpg"
-
 # Helper function to encode image to base64
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+def encode_image(image_bytes):
+    return base64.b64encode(image_bytes).decode('ascii')
 
 
-def groq_request():
-    load_dotenv()
-    client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+load_dotenv()
+# Created once, so the connection pool and auth are reused between requests
+client = AsyncGroq(api_key=os.getenv("GROQ_API_KEY"))
 
+async def groq_request(image_bytes: bytes):
     # Encode the image
     # (Groq/Llama needs the image sent as data, not an uploaded file ID)
-    base64_image = encode_image("image.jpg")
+    base64_image = encode_image(image_bytes)
 
     prompt_instruction = """
     based on the images you will be given and a list of human scents : Fragrant (e.g., florals, perfumes)
@@ -34,30 +32,28 @@ def groq_request():
         limit to one word!!!
     """
 
-    try:
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt_instruction},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}",
-                            },
+    # Errors are raised to the caller, so they are never cached or broadcast as if they were a scent
+    chat_completion = await client.chat.completions.create(
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt_instruction},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{base64_image}",
                         },
-                    ],
-                }
-            ],
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            temperature=0,
-
-            # Llama models sometimes chat too much, so we limit tokens to ensure concise output
-            max_completion_tokens=20,
-        )
-        return chat_completion.choices[0].message.content
-    except Exception as e:
-        return f"Error: {e}"
+                    },
+                ],
+            }
+        ],
+        model="meta-llama/llama-4-scout-17b-16e-instruct",
+        temperature=0,
+
+        # Llama models sometimes chat too much, so we limit tokens to ensure concise output
+        max_completion_tokens=20,
+    )
+    return chat_completion.choices[0].message.content
 
 #print(groq_request())
\ No newline at end of file
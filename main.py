@@ -1,219 +1,242 @@
 import uvicorn
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Request, WebSocket
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from groq import Groq
-import base64, os, asyncio, hashlib, time, queue, json
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ValidationError
+import base64, binascii, os, asyncio, zlib, logging
+import orjson
+from blake3 import blake3
+from cachetools import TTLCache
 from contextlib import asynccontextmanager
 
 from gemini_api import gemini_request
 from groq_api import groq_request
-from concurrent.futures import ThreadPoolExecutor
-import threading
-from typing import List
+from typing import Dict, Set, Union
+
+# Only warnings and errors by default, the per-request messages are debug level so their formatting is skipped
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
 
 class Image(BaseModel):
     image_base64: str
 
 # Global state
 # When the frontend uploads an image, it's put here, following the FIFO principle
-processing_queue = queue.Queue()
-broadcast_queue = queue.Queue()     # Queue for websocket broadcast to all clients
-current_scent_result = ""
+QUEUE_MAX_SIZE = 32                 # Each queued image is ~1MB, so the backlog has to be bounded
+processing_queue = asyncio.Queue(maxsize=QUEUE_MAX_SIZE)
+broadcast_queue = asyncio.Queue()   # Queue for websocket broadcast to all clients
 
-active_workers = 0
 MAX_WORKERS = 3                     # Processing only up to 3 images simultaneously
 
+BROADCAST_WINDOW = 0.02             # Seconds to wait for more results before broadcasting
+BROADCAST_MAX_BATCH = 128           # Upper bound on messages sent in a single frame
+COMPRESS_THRESHOLD = 1024           # Payloads bigger than this (in bytes) are sent zlib compressed
+COMPRESSED_FRAME_MARKER = b"\x01"   # First byte of a binary frame holding a zlib compressed payload
+
+MAX_IMAGE_SIZE = 5 * 1024 * 1024    # Uploads bigger than 5MB are rejected before decoding
+# Base64 is 4/3 of the binary size, plus some room for the JSON wrapper and the data URL prefix
+MAX_JSON_BODY_SIZE = MAX_IMAGE_SIZE * 4 // 3 + 1024
+# Only JPEG is accepted, that's the mime type the images are sent to the APIs with
+DATA_URL_PREFIX = "data:image/jpeg;base64,"
+JPEG_SOI_MARKER = b"\xff\xd8\xff"   # Start of image marker every JPEG file begins with
+
 # Simple in-memory cache for scent results
-scent_cache = {}
 CACHE_TTL = 300     # Cache will be alive for 300s
 CACHE_MAX_SIZE = 100
-
-# Thread pool for Gemini processing
-# Role: pre-create a pool of MAX_WORKERS ready to execute tasks (e.g. processing image)
-# *See more in documentation
-executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+# Entries expire after CACHE_TTL and the least recently used one is evicted in O(1) once full
+scent_cache = TTLCache(maxsize=CACHE_MAX_SIZE, ttl=CACHE_TTL)
+DUPLICATE_WAIT_TIMEOUT = 1.0        # Seconds a duplicate upload waits for the in-flight result
+# Images that are queued or being processed, so identical frames don't trigger a second API call.
+# Together with the cache this is a single-flight: a hash is either cached, pending or neither, the lookup and
+# the insert happen without an await in between, and the worker caches the result before removing the entry,
+# so there is at most one concurrent API call per image (once evicted from the cache it is processed again)
+pending_results: Dict[str, asyncio.Future] = {}
 
 # Standard manager for Websockets
 class ConnectionManager:
     def __init__(self):
-        # Handling active connections via two different lists because in makes implementing different
-        # messages for different types of clients easier (if needed)
-        self.active_connections: List[WebSocket] = []
-        self.esp8266_connections: List[WebSocket] = []
+        # Handling active connections via two different sets because in makes implementing different
+        # messages for different types of clients easier (if needed), sets make the removal O(1)
+        self.active_connections: Set[WebSocket] = set()
+        self.esp8266_connections: Set[WebSocket] = set()
 
     async def connect(self, websocket: WebSocket, client_type: str = "web"):    # Make the "web" default client type
         await websocket.accept()
         if client_type == "esp8266":
-            self.esp8266_connections.append(websocket)
-            print(f"esp8266 connected. Total esp8266 connections: {len(self.esp8266_connections)}")
+            self.esp8266_connections.add(websocket)
+            logger.debug("esp8266 connected. Total esp8266 connections: %d", len(self.esp8266_connections))
         else:
-            self.active_connections.append(websocket)
-            print(f"web client connected to websocket. Total web connections: {len(self.active_connections)}")
+            self.active_connections.add(websocket)
+            logger.debug("web client connected to websocket. Total web connections: %d", len(self.active_connections))
 
     def disconnect(self, websocket: WebSocket, client_type: str = "web"):
         if client_type == "esp8266":
-            if websocket in self.esp8266_connections:
-                self.esp8266_connections.remove(websocket)
-            print(f"esp8266 disconnected. Total esp8266 connections: {len(self.esp8266_connections)}")
+            self.esp8266_connections.discard(websocket)
+            logger.debug("esp8266 disconnected. Total esp8266 connections: %d", len(self.esp8266_connections))
         else:
-            if websocket in self.active_connections:
-                self.active_connections.remove(websocket)
-            print(f"web client disconnected. Total web connections: {len(self.active_connections)}")
-
-    async def broadcast_to_esp8266(self, message: str):
+            self.active_connections.discard(websocket)
+            logger.debug("web client disconnected. Total web connections: %d", len(self.active_connections))
+
+    async def _send_to_all(self, connections: Set[WebSocket], message: Union[str, bytes], client_type: str):
+        # Snapshot the connections so that connects/disconnects during the send don't affect the iteration
+        snapshot = list(connections)
+        # Compressed payloads go out as binary frames, everything else as text
+        if isinstance(message, bytes):
+            sends = (connection.send_bytes(message) for connection in snapshot)
+        else:
+            sends = (connection.send_text(message) for connection in snapshot)
+        # All sockets are written in parallel, an exception from one client does not cancel the others
+        results = await asyncio.gather(
+            *sends,
+            return_exceptions=True,
+        )
+
+        # Gracefully handle the disconnections of clients while sending data
+        disconnected = set()
+        for connection, result in zip(snapshot, results):
+            if isinstance(result, Exception):
+                logger.warning("failed to send to %s: %s", client_type, result)
+                # Here the problematic connection is handled so it does not cause any problems in future
+                disconnected.add(connection)
+            else:
+                logger.debug("message sent to %s successfully", client_type)
+
+        # Remove those disconnected clients, in place so the manager's set is updated
+        connections -= disconnected
+
+    async def broadcast_to_esp8266(self, message: Union[str, bytes]):
         # If there are active esp8266 connections
         if self.esp8266_connections:
-            # Gracefully handle the disconnections of clients while sending data
-            disconnected = []
-            for connection in self.esp8266_connections:
-                # Crucial to use try and expect
-                try:
-                    await connection.send_text(message)
-                    print(f"message sent to esp8266 successfully")
-                except Exception as e:
-                    print(f"failed to send to esp8266: {e}")
-                    # Here the problematic connection is handled so it does not cause any problems in future
-                    disconnected.append(connection)
-
-            # Remove those disconnected clients
-            for connection in disconnected:
-                self.esp8266_connections.remove(connection)
+            await self._send_to_all(self.esp8266_connections, message, "esp8266")
         else:
-            print("no esp connections available to broadcast")
+            logger.debug("no esp connections available to broadcast")
 
     # Similar to esp broadcast logic but for the web client
-    async def broadcast_to_web(self, message: str):
+    async def broadcast_to_web(self, message: Union[str, bytes]):
         if self.active_connections:
-            disconnected = []
-            for connection in self.active_connections:
-                try:
-                    await connection.send_text(message)
-                    print(f"message sent to web client successfully")
-                except Exception as e:
-                    print(f"failed to send to web: {e}")
-                    disconnected.append(connection)
-
-            for connection in disconnected:
-                self.active_connections.remove(connection)
+            await self._send_to_all(self.active_connections, message, "web client")
 
         # Impossible case in this specific application
         else:
-            print("no web connections available to broadcast")
+            logger.debug("no web connections available to broadcast")
 
 manager = ConnectionManager()   # Finished with websocket implementation
 
 # Caching functions
-def get_image_hash(image_base64):
-    """ Creates a hash from the base64 encoded image, used in further caching"""
-    # Since the MD5 operates only on binary data the base64 image will go through following steps:
-    # Base64 -> Binary -> Binary Hash -> Hexadecimal Hash
-    return hashlib.md5(image_base64.encode()).hexdigest()
+def get_image_hash(image_bytes: bytes):
+    """ Creates a hash from the image bytes, used in further caching"""
+    # The hash is only a cache key, so there is no need for a cryptographic one like MD5,
+    # BLAKE3 is much faster on big payloads and a 16 bytes digest is plenty to avoid collisions
+    return blake3(image_bytes).hexdigest(16)
 
 def get_cached_result(image_hash):
     """Verify whether the image has already been cached in memory"""
-    if image_hash in scent_cache:
-        # Key-value representation where the value is an array of 2 elements
-        result, timestamp = scent_cache[image_hash]
-        # Check the data 'freshness'
-        if time.time() - timestamp < CACHE_TTL:
-            return result
-        else:
-            # Remove expired entry
-            del scent_cache[image_hash]
-    return None
+    # Expired entries are dropped by the cache itself
+    return scent_cache.get(image_hash)
 
 def cache_results(image_hash, result):
     """Cache the result"""
-    if len(scent_cache) > CACHE_MAX_SIZE:
-        # Find the key in the cache that has the smallest timestamp
-        # Using the lambda comparator for the min function, it looks at all timestamps for each key
-        oldest_key = min(scent_cache.keys(), key=lambda k: scent_cache[k][1])
-        del scent_cache[oldest_key]
-
-    scent_cache[image_hash] = (result, time.time())
+    scent_cache[image_hash] = result
 
 # Core logic
-def process_image_worker(image_base64):
+def encode_frame(payload: bytes):
+    """Prepare the websocket frame once for all the clients, compressing it only when it's worth it"""
+    if len(payload) > COMPRESS_THRESHOLD:
+        compressed = zlib.compress(payload)
+        if len(compressed) + 1 < len(payload):
+            return COMPRESSED_FRAME_MARKER + compressed
+    return payload.decode()
+
+def queue_broadcast(scent_result):
+    """Queue the message for the broadcast consumer, so that the producers don't wait for the websockets"""
+    clean_result = scent_result.strip('"').strip("'")
+    # Kept as a dict, the whole batch is serialized at once by the broadcast consumer
+    message = {"message": clean_result}
+    broadcast_queue.put_nowait(message)
+    logger.debug("queued broadcast message: %s", message)
+
+async def process_image_worker(image_hash: str, image_bytes: bytes, future: asyncio.Future):
     """Worker function that processes a single image"""
-    global current_scent_result, active_workers
+    result = None
 
     try:
-        # First check the cache
-        image_hash = get_image_hash(image_base64)
-        cached_result = get_cached_result(image_hash)
-
-        if cached_result:
-            print(f"cache hit for {image_hash[:8]}")
-            current_scent_result = cached_result
-        else:
-            print(f"cache miss for {image_hash[:8]}, processing image")
-            # ! Could arise conflict between workers, because they use the same path
-            file_path = "image.jpg"
-
-            # Create the image for the gemini api
-            with open(file_path, "wb") as f:
-                f.write(base64.b64decode(image_base64[23:]))
-
-            result = groq_request()
+        logger.debug("cache miss for %.8s, processing image", image_hash)
+        result = await groq_request(image_bytes)
+        logger.debug("gemini result: %s", result)
+        # The model can return no or empty content, that is neither cached nor broadcast, so every cached
+        # result is a real one. Each worker broadcasts its own result, nothing is shared between overlapping workers
+        if result:
             cache_results(image_hash, result)
-            current_scent_result = result
-            print(f"gemini result: {result}")
-
-            os.remove(file_path)
-
-        # Queue the message for the main loop to handle, so that the workers don't interact with asyncio function
-        if current_scent_result:
-            clean_result = current_scent_result.strip('"').strip("'")
-            # Serialize the cleaned python string into a JSON string
-            message = json.dumps({"message": clean_result})
-            broadcast_queue.put(message)
-            print(f"queued broadcast message: {message}")
+            queue_broadcast(result)
 
-    except Exception as e:
-        print(f"error processing image: {e}")
+    except Exception:
+        logger.exception("error processing image")
     finally:
-        active_workers -= 1
-
-# Background loop
-async def processing_loop():
-    global active_workers
-
+        # Wake up the duplicate uploads that are waiting for this image
+        # (a successful result is already cached at this point, so no new upload can slip in between)
+        pending_results.pop(image_hash, None)
+        if not future.done():
+            future.set_result(result)
+
+# Background consumers
+async def worker():
+    """Waits for images and processes them, one at a time"""
     while True:
-        if not processing_queue.empty() and MAX_WORKERS > active_workers:
-            image_base64 = processing_queue.get()
-            active_workers += 1
-
-            # Submit to the thread pool
-            executor.submit(process_image_worker, image_base64)
-            print(f"processing image, active workers: {active_workers}")
-
-        if not broadcast_queue.empty():
-            message = broadcast_queue.get()
-            print(f"processing broadcast message: {message}")
-
-            await manager.broadcast_to_esp8266(message)
-            await manager.broadcast_to_web(message)
-
-        # A very important pause for HTTP requests
-        await asyncio.sleep(0.1)
+        image_hash, image_bytes, future = await processing_queue.get()
+        try:
+            await process_image_worker(image_hash, image_bytes, future)
+        finally:
+            processing_queue.task_done()
+
+def get_active_workers():
+    """Number of images being processed right now"""
+    # Every pending image is either waiting in the queue or held by a worker, so no counter has to be kept
+    return len(pending_results) - processing_queue.qsize()
+
+async def broadcast_consumer():
+    """Waits for processed results and sends them to every connected client"""
+    while True:
+        # Block until there is at least one message, then give the others a short window to arrive
+        first = await broadcast_queue.get()
+        batch = [first]
+        await asyncio.sleep(BROADCAST_WINDOW)
+
+        # Drain whatever accumulated, so N results cost a single write per client
+        while len(batch) < BROADCAST_MAX_BATCH:
+            try:
+                batch.append(broadcast_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+        # Serialized (and compressed if needed) only once for all the clients
+        frame = encode_frame(orjson.dumps({"messages": batch}))
+        logger.debug("processing broadcast of %d message(s)", len(batch))
+        try:
+            await asyncio.gather(
+                manager.broadcast_to_esp8266(frame),
+                manager.broadcast_to_web(frame),
+            )
+        finally:
+            for _ in batch:
+                broadcast_queue.task_done()
 
 # Manage startup and shutdown events
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Start background loop
-    task = asyncio.create_task(processing_loop())
+    # Start the consumers, the number of image workers is what bounds the concurrency
+    tasks = [asyncio.create_task(broadcast_consumer())]
+    tasks += [asyncio.create_task(worker()) for _ in range(MAX_WORKERS)]
     yield
-    # Stop loop on shutdown
-    task.cancel()
+    # Stop consumers on shutdown
+    for task in tasks:
+        task.cancel()
 
     # Handling clean shutdown
-    try:
-        await task
-    except asyncio.CancelledError:
-        pass
+    await asyncio.gather(*tasks, return_exceptions=True)
 
-app = FastAPI(lifespan=lifespan)
+# orjson is a lot faster than the standard json module for every REST response
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -226,17 +249,19 @@ app.add_middleware(
 # Mostly for development debugging, will not be used in actual app
 @app.get("/processing")
 async def get_processing_state():
+    active_workers = get_active_workers()
     return {
         "processing": active_workers > 0,
         "active_workers": active_workers,
         "max_workers": MAX_WORKERS,
-        "queue_size": processing_queue.qsize()
+        "queue_size": processing_queue.qsize(),
+        "max_queue_size": QUEUE_MAX_SIZE
     }
 
 @app.get("/cache_stats")
 async def get_cache_stats():
     return {
-        "cache_size": len(scent_cache),
+        "cache_size": scent_cache.currsize,
         "max_cache_size": CACHE_MAX_SIZE,
         "cache_ttl": CACHE_TTL
     }
@@ -244,9 +269,11 @@ async def get_cache_stats():
 @app.post("/test-broadcast")
 async def test_broadcast():
     """Test endpoint to manually trigger a broadcast to all clients"""
-    test_message = json.dumps({"message": "test_scent"})
-    await manager.broadcast_to_esp8266(test_message)
-    await manager.broadcast_to_web(test_message)
+    test_message = orjson.dumps({"messages": [{"message": "test_scent"}]}).decode()
+    await asyncio.gather(
+        manager.broadcast_to_esp8266(test_message),
+        manager.broadcast_to_web(test_message),
+    )
     return {
         "status": "broadcast_sent",
         "message": test_message,
@@ -254,33 +281,136 @@ async def test_broadcast():
         "web_connections": len(manager.active_connections)
     }
 
-# Actual used API endpoints
-@app.post("/upload-frame")
-async def upload_image(image: Image):
-    # Add to processing queue
-    processing_queue.put(image.image_base64)
+async def enqueue_image(image_bytes: bytes):
+    """Answers from the cache or an in-flight duplicate if possible, otherwise queues the image"""
+    # Every JPEG starts with the SOI marker, anything else would only waste a worker (checked for both endpoints)
+    if image_bytes[:3] != JPEG_SOI_MARKER:
+        raise HTTPException(status_code=400, detail="not a JPEG image")
+
+    image_hash = get_image_hash(image_bytes)
+
+    # First check the cache
+    cached_result = get_cached_result(image_hash)
+    if cached_result is not None:
+        logger.debug("cache hit for %.8s", image_hash)
+        queue_broadcast(cached_result)
+        return {"status": "cached", "result": cached_result}
+
+    # The same frame is already on its way, wait for it instead of paying for a second API call
+    # (shielded, so a client disconnecting or the timeout doesn't cancel the result for everybody else).
+    # The wait is short, a duplicate should not hang while the whole queue drains
+    if image_hash in pending_results:
+        logger.debug("duplicate of in-flight image %.8s", image_hash)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(pending_results[image_hash]), DUPLICATE_WAIT_TIMEOUT)
+            return {"status": "processed", "result": result}
+        except asyncio.TimeoutError:
+            # Still pending, the result will reach the client through the websocket broadcast
+            return queued_response()
+
+    future = asyncio.get_running_loop().create_future()
+    try:
+        processing_queue.put_nowait((image_hash, image_bytes, future))
+    except asyncio.QueueFull:
+        # Frames are produced faster than they can be processed, let the client back off
+        raise HTTPException(status_code=429, detail="busy")
+    pending_results[image_hash] = future
+
+    return queued_response()
+
+def queued_response():
     return {
         "status": "queued",
         "queue_position": processing_queue.qsize(),
-        "active_workers": active_workers
+        "active_workers": get_active_workers()
     }
 
+async def read_body(request: Request, max_size: int):
+    """Reads the request body, answering 413 as soon as it gets bigger than max_size"""
+    # Reject oversized uploads from the header when possible, before reading anything
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > max_size:
+        raise HTTPException(status_code=413, detail="image too large")
+
+    # The header can be missing or lie, so the body is also read incrementally and cut off past the limit
+    buffer = bytearray()
+    async for chunk in request.stream():
+        buffer += chunk
+        if len(buffer) > max_size:
+            raise HTTPException(status_code=413, detail="image too large")
+    return bytes(buffer)
+
+# Actual used API endpoints
+# The body is read by hand so its size is capped before the JSON is parsed, the schema is kept for the docs
+@app.post(
+    "/upload-frame",
+    openapi_extra={
+        "requestBody": {"content": {"application/json": {"schema": Image.model_json_schema()}}, "required": True}
+    },
+)
+async def upload_image(request: Request):
+    body = await read_body(request, MAX_JSON_BODY_SIZE)
+    try:
+        image = Image.model_validate_json(body)
+    except ValidationError as e:
+        # Same 422 response FastAPI gives for an invalid body
+        raise RequestValidationError(e.errors())
+
+    # Validate and decode once, so bogus payloads fail here instead of taking a worker
+    if not image.image_base64.startswith(DATA_URL_PREFIX):
+        raise HTTPException(status_code=400, detail="expected a data:image/jpeg;base64 URL")
+    try:
+        # validate=True rejects anything outside the base64 alphabet, the decoding of a few MB
+        # runs in a thread so it doesn't block the websockets and the other uploads
+        image_bytes = await asyncio.to_thread(
+            base64.b64decode, image.image_base64[len(DATA_URL_PREFIX):], validate=True
+        )
+    except binascii.Error:
+        raise HTTPException(status_code=400, detail="invalid base64 data")
+    return await enqueue_image(image_bytes)
+
+@app.post("/upload-frame-bin")
+async def upload_image_bin(request: Request):
+    # The raw JPEG is posted as the body (Content-Type: image/jpeg), no base64 or JSON to go through
+    content_type = request.headers.get("content-type", "").split(";", 1)[0].strip()
+    if content_type != "image/jpeg":
+        raise HTTPException(status_code=400, detail="expected Content-Type: image/jpeg")
+
+    image_bytes = await read_body(request, MAX_IMAGE_SIZE)
+    return await enqueue_image(image_bytes)
+
+async def wait_for_disconnect(websocket: WebSocket):
+    """Clients only listen, so incoming frames are discarded until the disconnect arrives"""
+    # Dead connections are detected by uvicorn's ping/pong (on by default, every 20s),
+    # which delivers the disconnect here
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
 @app.websocket("/ws/web")
 async def websocket_web_endpoint(websocket: WebSocket):
     await manager.connect(websocket, "web")
     try:
-        while True:
-            # Keep connection alive
-            await websocket.receive_text()
-    except WebSocketDisconnect:
+        await wait_for_disconnect(websocket)
+    finally:
         manager.disconnect(websocket, "web")
 
 @app.websocket("/ws/esp8266")
 async def websocket_esp8266_endpoint(websocket: WebSocket):
     await manager.connect(websocket, "esp8266")
     try:
-        while True:
-            await websocket.receive_text()
-    except WebSocketDisconnect:
+        await wait_for_disconnect(websocket)
+    finally:
         manager.disconnect(websocket, "esp8266")
 
+if __name__ == "__main__":
+    # uvicorn's default "auto" loop and http settings pick uvloop and httptools when they are installed
+    # (both are in requirements.txt) and fall back to asyncio and h11 otherwise, e.g. on Windows
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8000)),
+        # Broadcast frames are compressed once by the app, not again for every client
+        ws_per_message_deflate=False,
+    )